@@ -8,10 +8,18 @@ import numbers
 import math
 from types import new_class
 import shlex
-from itertools import accumulate
+from itertools import accumulate, groupby, islice
+import heapq
 import functools
 from argparse import ArgumentParser
 from os.path import basename
+import subprocess
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                CancelledError, wait, FIRST_COMPLETED)
+import asyncio
+from array import array
+from bisect import bisect_left
+import mmap
 
 import logging
 log = logging.getLogger(__name__)
@@ -60,9 +68,17 @@ AUTO_COLORS = (
 )
 
 DEFAULT_BONUS_DATES = ((1,1), (6, 1))
+DEFAULT_HOLIDAYS = ((1, 1), (7, 4), (12, 25))
+DEFAULT_ROLL = "modified_following"
+ALL_MONTH_DAYS = frozenset((d.month, d.day)
+                           for d in (date(2016, 1, 1) + timedelta(n)
+                                     for n in range(366)))
 DEFAULT_REFESHER_DATES = ((1, 1))
 
+DEFAULT_SENSITIVITY_INCOMES = tuple(range(10000, 1000001, 5000))
+
 DEFAULT_TERMINAL = 'wxt font "times,20" size 2000,1000'
+DEFAULT_GNUPLOT = "gnuplot"
 
 NO_TAXES = (
     (0, inf),
@@ -125,6 +141,29 @@ STATE_STANDARD_DEDUCTIONS_2016 = {
     "WA": 0,
 }
 
+class TaxLiability(namedtuple("TaxLiability", (
+        "income",
+        "federal_tax",
+        "amt",
+        "state_tax",
+        "state_sdi",
+        "medicare_tax",
+        "social_security_tax"))):
+    """Tax owed for one year, as computed by Taxes.calculate_liability"""
+    __slots__ = ()
+
+    @property
+    def amt_binding(self):
+        """True if the AMT exceeds the regular federal tax."""
+        return self.amt > self.federal_tax
+
+    @property
+    def total(self):
+        """Total liability: federal (or AMT), state, SDI, and payroll."""
+        return (max(self.federal_tax, self.amt) + self.state_tax +
+                self.state_sdi + self.medicare_tax +
+                self.social_security_tax)
+
 class Taxes(object):
     """Calculate income taxation"""
     def __init__(self,
@@ -174,6 +213,16 @@ class Taxes(object):
         these tuples represent income of any sort.  We need to know
         total income because the effective tax rate depends on total
         income for a calendar year.  """
+        self.personal_exemption = personal_exemption
+        self.amt_exemption = amt_exemption
+        self.amt_brackets = amt_brackets
+        self.federal_standard_deduction = federal_standard_deduction
+        self.federal_brackets = federal_brackets
+        self.medicare_brackets = medicare_brackets
+        self.social_security_brackets = social_security_brackets
+        self.state_standard_deductions = state_standard_deductions
+        self.state_brackets = state_brackets
+        self.state_ssdi_brackets = state_ssdi_brackets
         income_by_year = defaultdict(functools.partial(defaultdict, int))
         self.__income_dates = set()
         for date, amount, state in income_events:
@@ -182,68 +231,73 @@ class Taxes(object):
         self.__income_by_year = income_by_year
         self.__tax_by_year = {}
         for year in sorted(income_by_year):
-            iby = income_by_year[year]
-            income = sum(iby.values())
-            total_state_tax = 0
-            for state, state_income in sorted(iby.items()):
-                sb = state_brackets[state]
-                ssd = state_standard_deductions[state]
-                state_agi = max(0, state_income - ssd)
-                state_tax = Taxes.calculate_due(state_agi, sb)
-                state_sdi = Taxes.calculate_due(
-                    state_income,
-                    state_ssdi_brackets[state])
-                log.debug(("year:%r state:%r state_income:%g "
-                           "state_agi:%g state_tax:%g state_sdi:%g "
-                           "rate:%g%%"),
-                          year, state, state_income, state_agi, state_tax,
-                          state_sdi,
-                          100.0*((state_tax + state_sdi) / state_income))
-                total_state_tax += state_tax + state_sdi
-
-            pe_phaseout = ((income - personal_exemption[1]) /
-                           (personal_exemption[2] - personal_exemption[1]))
-            pe_phaseout = min(max(0, pe_phaseout), 1)
-            effective_pe = personal_exemption[0] * (1 - pe_phaseout)
-
-            federal_agi = max(0, income - effective_pe)
-            federal_itemized_deduction = total_state_tax
-            federal_deduction = max(federal_itemized_deduction,
-                                    federal_standard_deduction)
-            federal_tax = Taxes.calculate_due(
-                max(0, federal_agi - federal_deduction),
-                federal_brackets)
-            amti = income
-            amte_phaseout = ((amti - amt_exemption[1]) /
-                             (amt_exemption[2] - amt_exemption[1]))
-            amte_phaseout = min(max(0, amte_phaseout), 1)
-            effective_amte = amt_exemption[0] * (1 - amte_phaseout)
-            amt_base = max(0, amti - effective_amte)
-            amt = Taxes.calculate_due(amt_base, amt_brackets)
-
-            if federal_tax < amt:
+            liability = self.calculate_liability(income_by_year[year])
+            if liability.amt_binding:
                 log.info("AMT!!! year:%s income:%g fedtax:%g amtax:%g",
-                         year, income, federal_tax, amt)
-            total_tax = max(federal_tax, amt) + state_tax
-            self.__tax_by_year[year] = federal_tax + state_tax
-
-            medicare_tax = Taxes.calculate_due(
-                income, medicare_brackets)
-            total_tax += medicare_tax
-
-            social_security_tax = Taxes.calculate_due(
-                income, social_security_brackets)
-            total_tax += social_security_tax
-
-            log.debug(("year:%r income:%g effpe:%g totded:%g fedagi:%g "
-                       "total_tax:%g rate:%g%%"),
-                      year,
-                      income,
-                      effective_pe,
-                      federal_deduction,
-                      federal_agi,
-                      total_tax,
-                      100.0 * (total_tax / income))
+                         year, liability.income, liability.federal_tax,
+                         liability.amt)
+            self.__tax_by_year[year] = liability.total
+            log.debug("year:%r %r", year, liability)
+
+    def calculate_liability(self, income_by_state):
+        """Calculate tax liability for one calendar year.
+
+        INCOME_BY_STATE is a mapping from state abbreviation to
+        income earned in that state during the year.  Return a
+        TaxLiability tuple."""
+        income = sum(income_by_state.values())
+        total_state_tax = 0
+        total_state_sdi = 0
+        for state, state_income in sorted(income_by_state.items()):
+            sb = self.state_brackets[state]
+            ssd = self.state_standard_deductions[state]
+            state_agi = max(0, state_income - ssd)
+            state_tax = Taxes.calculate_due(state_agi, sb)
+            state_sdi = Taxes.calculate_due(
+                state_income,
+                self.state_ssdi_brackets[state])
+            log.debug(("state:%r state_income:%g "
+                       "state_agi:%g state_tax:%g state_sdi:%g"),
+                      state, state_income, state_agi, state_tax, state_sdi)
+            total_state_tax += state_tax
+            total_state_sdi += state_sdi
+
+        personal_exemption = self.personal_exemption
+        pe_phaseout = ((income - personal_exemption[1]) /
+                       (personal_exemption[2] - personal_exemption[1]))
+        pe_phaseout = min(max(0, pe_phaseout), 1)
+        effective_pe = personal_exemption[0] * (1 - pe_phaseout)
+
+        federal_agi = max(0, income - effective_pe)
+        federal_itemized_deduction = total_state_tax + total_state_sdi
+        federal_deduction = max(federal_itemized_deduction,
+                                self.federal_standard_deduction)
+        federal_tax = Taxes.calculate_due(
+            max(0, federal_agi - federal_deduction),
+            self.federal_brackets)
+
+        amt_exemption = self.amt_exemption
+        amti = income
+        amte_phaseout = ((amti - amt_exemption[1]) /
+                         (amt_exemption[2] - amt_exemption[1]))
+        amte_phaseout = min(max(0, amte_phaseout), 1)
+        effective_amte = amt_exemption[0] * (1 - amte_phaseout)
+        amt_base = max(0, amti - effective_amte)
+        amt = Taxes.calculate_due(amt_base, self.amt_brackets)
+
+        medicare_tax = Taxes.calculate_due(
+            income, self.medicare_brackets)
+        social_security_tax = Taxes.calculate_due(
+            income, self.social_security_brackets)
+
+        return TaxLiability(
+            income = income,
+            federal_tax = federal_tax,
+            amt = amt,
+            state_tax = total_state_tax,
+            state_sdi = total_state_sdi,
+            medicare_tax = medicare_tax,
+            social_security_tax = social_security_tax)
 
     @staticmethod
     def calculate_due(gross_pay, brackets):
@@ -279,6 +333,230 @@ class Taxes2016(Taxes):
             state_ssdi_brackets = STATE_SSDI_BRACKETS_2016,
             income_events = income_events)
 
+class TaxSurface(namedtuple("TaxSurface", (
+        "incomes",
+        "splits",
+        "liabilities",
+        "effective",
+        "marginal",
+        "amt_binding"))):
+    """Tax rates over a grid of incomes and state splits
+
+    INCOMES and SPLITS are the grid axes, as given to tax_sensitivity.
+    The other fields are tuples with one row per split, each row a
+    tuple with one entry per income: LIABILITIES holds TaxLiability
+    objects, EFFECTIVE and MARGINAL hold rates as fractions, and
+    AMT_BINDING holds booleans."""
+    __slots__ = ()
+
+def tax_sensitivity(incomes = DEFAULT_SENSITIVITY_INCOMES,
+                    splits = ({"CA": 1.0}, {"WA": 1.0}),
+                    *,
+                    taxes = Taxes2016,
+                    delta = 1000):
+    """Evaluate yearly tax liability over a grid.
+
+    INCOMES is a sequence of yearly incomes, in dollars.  SPLITS is a
+    sequence of mappings from state abbreviation to the fraction of
+    income earned in that state; each mapping's fractions must sum
+    to one.  TAXES is a Taxes subclass, as for make_offer_comparison.
+
+    The effective rate at each point is total liability divided by
+    income.  The marginal rate is the extra liability on DELTA more
+    dollars of income, split the same way, divided by DELTA.
+
+    Return a TaxSurface."""
+    typecheck(incomes, seq_of(numbers.Real))
+    typecheck(delta, numbers.Real)
+    if delta <= 0:
+        raise ValueError("delta must be positive", delta)
+    if not issubclass(taxes, Taxes):
+        raise TypeError(taxes)
+    for split in splits:
+        if not math.isclose(sum(split.values()), 1.0, rel_tol=1e-5):
+            raise ValueError("state split does not sum to 1", split)
+    calculator = taxes(())
+
+    def liability(income, split):
+        return calculator.calculate_liability(
+            {state: fraction * income for state, fraction in split.items()})
+
+    liabilities = []
+    effective = []
+    marginal = []
+    amt_binding = []
+    for split in splits:
+        row = tuple(liability(income, split) for income in incomes)
+        bumped = tuple(liability(income + delta, split)
+                       for income in incomes)
+        liabilities.append(row)
+        effective.append(tuple(l.total / l.income if l.income else 0.0
+                               for l in row))
+        marginal.append(tuple((b.total - l.total) / delta
+                              for l, b in zip(row, bumped)))
+        amt_binding.append(tuple(l.amt_binding for l in row))
+    return TaxSurface(
+        incomes = tuple(incomes),
+        splits = tuple(dict(split) for split in splits),
+        liabilities = tuple(liabilities),
+        effective = tuple(effective),
+        marginal = tuple(marginal),
+        amt_binding = tuple(amt_binding))
+
+def describe_split(split):
+    """Return a short human-readable label for a state SPLIT."""
+    if len(split) == 1:
+        return next(iter(split))
+    return "/".join("%s %g%%" % (state, 100.0 * fraction)
+                    for state, fraction in sorted(split.items()))
+
+class PriceSeries(object):
+    """Share price history, indexed by date"""
+    def __init__(self, days, prices, *, annual_growth = 0.0):
+        """Create a price series.
+
+        DAYS is a sequence of datetime.date objects on which the
+        share price is known (usually trading days); PRICES is a
+        parallel sequence of closing prices, in dollars.  DAYS need
+        not be sorted, but may not contain duplicates.
+
+        ANNUAL_GROWTH is the fractional yearly price growth assumed
+        when projecting prices past the last known day.  The default
+        projects the last known price forever.
+
+        """
+        pairs = sorted(zip((d.toordinal() for d in days), prices))
+        self.__init_arrays(array("i", (d for d, _ in pairs)),
+                           array("d", (p for _, p in pairs)),
+                           annual_growth)
+
+    def __init_arrays(self, ordinals, prices, annual_growth):
+        """Initialize from parallel arrays, ORDINALS sorted."""
+        typecheck(annual_growth, numbers.Real)
+        if not ordinals:
+            raise ValueError("empty price series")
+        if len(ordinals) != len(prices):
+            raise ValueError("mismatched price series",
+                             len(ordinals), len(prices))
+        for d1, d2 in zip(ordinals, islice(ordinals, 1, None)):
+            if d1 >= d2:
+                raise ValueError("duplicate or unsorted price date",
+                                 date.fromordinal(d2))
+        self.ordinals = ordinals
+        self.prices = prices
+        self.annual_growth = annual_growth
+
+    @classmethod
+    def from_csv(cls, path, *,
+                 date_column = 0,
+                 price_column = 1,
+                 delimiter = ",",
+                 **kwargs):
+        """Load a price series from a CSV file at PATH.
+
+        DATE_COLUMN and PRICE_COLUMN are the zero-based column numbers
+        of the date (in YYYY-MM-DD form) and price fields; either may
+        be enclosed in double quotes.  Lines whose date field does not
+        parse, like a header line, are skipped; a line with a valid
+        date but a missing or invalid price raises ValueError.
+        The file is memory-mapped and parsed a line at a time.
+        Remaining keyword arguments go to the constructor."""
+        sep = delimiter.encode("ascii")
+        days = []
+        prices = []
+        with open(path, "rb") as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for lineno, line in enumerate(iter(m.readline, b""), 1):
+                fields = line.split(sep)
+                try:
+                    ds = fields[date_column].strip().strip(b'"')
+                    day = date(int(ds[0:4]), int(ds[5:7]), int(ds[8:10]))
+                except (IndexError, ValueError):
+                    continue
+                try:
+                    price = float(fields[price_column].strip().strip(b'"'))
+                except (IndexError, ValueError):
+                    raise ValueError("invalid price", path, lineno,
+                                     line.rstrip(b"\r\n")) from None
+                days.append(day)
+                prices.append(price)
+        return cls(days, prices, **kwargs)
+
+    @classmethod
+    def from_binary(cls, path, *, annual_growth = 0.0):
+        """Load a price series from a binary file at PATH.
+
+        For a series of N prices, the file holds N little-endian
+        32-bit proleptic Gregorian ordinals (as from date.toordinal),
+        in strictly increasing order, followed by N little-endian
+        doubles giving the corresponding prices; write_binary
+        produces this format.  The columns are loaded directly from
+        the memory-mapped file.  ANNUAL_GROWTH is as for the
+        constructor."""
+        ordinals = array("i")
+        prices = array("d")
+        record_size = ordinals.itemsize + prices.itemsize
+        with open(path, "rb") as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, \
+             memoryview(m) as view:
+            if len(view) % record_size:
+                raise ValueError("truncated price file", path)
+            split = len(view) // record_size * ordinals.itemsize
+            ordinals.frombytes(view[:split])
+            prices.frombytes(view[split:])
+        if sys.byteorder != "little":
+            ordinals.byteswap()
+            prices.byteswap()
+        series = cls.__new__(cls)
+        series.__init_arrays(ordinals, prices, annual_growth)
+        return series
+
+    def write_binary(self, path):
+        """Write this series to PATH in the format from_binary reads."""
+        ordinals = array("i", self.ordinals)
+        prices = array("d", self.prices)
+        if sys.byteorder != "little":
+            ordinals.byteswap()
+            prices.byteswap()
+        with open(path, "wb") as f:
+            ordinals.tofile(f)
+            prices.tofile(f)
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def _price_at(self, ordinal, lo):
+        """Return (PRICE, INDEX) for ORDINAL, searching from LO."""
+        i = bisect_left(self.ordinals, ordinal, lo)
+        if i < len(self.ordinals):
+            if i == 0 and ordinal < self.ordinals[0]:
+                raise ValueError("date precedes price series",
+                                 date.fromordinal(ordinal))
+            return self.prices[i], i
+        years = (ordinal - self.ordinals[-1]) / 365.25
+        return self.prices[-1] * (1 + self.annual_growth) ** years, i
+
+    def price_on(self, day):
+        """Return the share price on DAY.
+
+        If DAY is not in the series (say, it falls on a weekend), use
+        the price on the next day that is.  Past the end of the
+        series, project the last price using the annual growth rate."""
+        return self._price_at(day.toordinal(), 0)[0]
+
+    def prices_on(self, days):
+        """Return a list of share prices, one for each date in DAYS.
+
+        Equivalent to calling price_on for each day, but visits the
+        days in sorted order so that each binary search only covers
+        the part of the series not already passed."""
+        days = tuple(days)
+        result = [None] * len(days)
+        lo = 0
+        for n in sorted(range(len(days)), key=lambda n: days[n]):
+            result[n], lo = self._price_at(days[n].toordinal(), lo)
+        return result
+
 class RsuGrant(object):
     """Equity grant"""
     def __init__(self,
@@ -286,7 +564,8 @@ class RsuGrant(object):
                  total,
                  start = None,
                  vesting_dates = DEFAULT_VESTING_DATES,
-                 vesting = (0.25, 0.25, 0.25, 0.25)):
+                 vesting = (0.25, 0.25, 0.25, 0.25),
+                 grant_price = None):
         """Create an equity grant description.
 
         TOTAL is the total size, in dollars, of the grant.  START is
@@ -301,6 +580,10 @@ class RsuGrant(object):
         and the value of the number indicates the portion of the grant that 
         vests in that year.
 
+        GRANT_PRICE is the share price used to convert TOTAL into a
+        number of shares when the offer has a price series.  If None,
+        use the series price on the grant start date.
+
         """
         self.total = typecheck(total, numbers.Real)
         self.start = typecheck(start, (date, timedelta, type(None)))
@@ -308,6 +591,7 @@ class RsuGrant(object):
         self.vesting = typecheck(vesting, seq_of(numbers.Real))
         if not math.isclose(sum(vesting), 1.0, rel_tol=1e-5):
             raise ValueError("vesting fractions do not sum to 1: %1.5f" % sum(vesting))
+        self.grant_price = typecheck(grant_price, (numbers.Real, type(None)))
 
 class Offer(object):
     """Describes an offer"""
@@ -321,7 +605,8 @@ class Offer(object):
                  bonus_dates = DEFAULT_BONUS_DATES,
                  refresher_amount = 0,
                  refresher_dates = DEFAULT_REFESHER_DATES,
-                 grants = ()):
+                 grants = (),
+                 prices = None):
         """Object representing an offer.
 
         NAME is a string giving the name of the offer, usually
@@ -348,6 +633,12 @@ class Offer(object):
         GRANTS is a sequence of RsuGrant objects; see the help for the
         RsuGrant class.
 
+        PRICES is a PriceSeries object or None.  If it is a
+        PriceSeries, each grant is converted to shares at its grant
+        price and each vest is valued at the share price on its vest
+        date.  If None, vests are worth fixed fractions of the grant
+        total.
+
         """
         self.name = typecheck(name, str)
         self.base = typecheck(base, numbers.Real)
@@ -361,66 +652,229 @@ class Offer(object):
         self.bonus_dates = typecheck(bonus_dates, seq_of(pair_of(int)))
         self.refresher_amount = typecheck(refresher_amount, numbers.Real)
         self.refresher_dates = typecheck(bonus_dates, seq_of(pair_of(int)))
+        self.prices = typecheck(prices, (PriceSeries, type(None)))
 
-def iterdates(start, end):
-    return (start + timedelta(n) for n in range(0, (end - start).days))
+class RenderTarget(object):
+    """Describes one rendering of an offer comparison"""
+    def __init__(self, *,
+                 output,
+                 terminal = None,
+                 series = None,
+                 title = None,
+                 show_dollars = None,
+                 script = None):
+        """Object representing a single graph to render.
+
+        OUTPUT is the name of the file gnuplot should write.  TERMINAL
+        is a gnuplot terminal string.  SERIES, TITLE, and
+        SHOW_DOLLARS are as for make_offer_comparison.  Any of these
+        that are None default to the value given to (or parsed by)
+        make_offer_comparison.
+
+        SCRIPT is the name of the gnuplot script file to write for
+        this target; if None, it is OUTPUT with ".gp" appended.
 
-def pay_info(offer,
-             day,
-             start_date,
-             paydays,
-             vests):
-    """Determine pay on a given day.
-
-    OFFER is an Offer object; DAY is a datetime.date.  PAYDAYS is a
-    tuple of day-numbers-of-month on which normal cash pay is
-    received; VESTS is a sequence of vesting events as generated by
-    the make_vests function.
-
-    Return a tuple of (CASH, EQUITY), either or both of which may
-    be zero."""
-
-    cash = 0
-    equity = 0
-    if day == start_date:
-        cash += offer.bonus
-    elif day.day in paydays:
-        cash += offer.base / (12*len(paydays))
-    if (day.month, day.day) in offer.bonus_dates:
-        nbonus = len(offer.bonus_dates)
-        bonus_period = 365 / nbonus
-        bonus_amount = (offer.bonus_target * offer.base) \
-                       / len(offer.bonus_dates)
-        bonus_amount *= min(1.0, (day - start_date).days / bonus_period)
-        cash += bonus_amount
+        """
+        self.output = typecheck(output, str)
+        self.terminal = typecheck(terminal, (str, type(None)))
+        self.series = typecheck(series, (seq_of(str), type(None)))
+        self.title = typecheck(title, (str, type(None)))
+        self.show_dollars = typecheck(show_dollars, (bool, type(None)))
+        self.script = typecheck(script, (str, type(None)))
+
+class PayCalendar(object):
+    """Business-day calendar for paydays, bonuses, and vests"""
+    ROLL_CONVENTIONS = (
+        None,
+        "following",
+        "modified_following",
+        "preceding",
+        "modified_preceding",
+    )
 
-    for voffer, vdate, vamount in vests:
-        if voffer is offer and vdate == day:
-            equity += vamount
-    return (cash, equity)
+    def __init__(self,
+                 *,
+                 holidays = DEFAULT_HOLIDAYS,
+                 roll = DEFAULT_ROLL,
+                 weekend = (5, 6)):
+        """Create a calendar.
+
+        HOLIDAYS is a sequence of non-business days, each either a
+        datetime.date or a (MONTH, DAY) pair that recurs every year.
+        WEEKEND is a sequence of weekday numbers (as from
+        date.weekday) that are never business days.
+
+        ROLL is the convention for moving a scheduled date that is
+        not a business day.  "following" moves it to the next business
+        day and "preceding" to the previous one.  The "modified_"
+        variants do the same unless that would change the month, in
+        which case they roll the other way; this keeps income in the
+        month, and so the tax year, in which it was scheduled.  If
+        ROLL is None, dates are not adjusted.
+
+        Expanded schedules are cached per year, so a calendar is
+        cheap to reuse across offers.
+
+        """
+        if roll not in self.ROLL_CONVENTIONS:
+            raise ValueError("unknown roll convention", roll)
+        self.roll_convention = roll
+        self.weekend = frozenset(typecheck(weekend, seq_of(int)))
+        self.holiday_dates = frozenset(
+            h for h in holidays if isinstance(h, date))
+        self.annual_holidays = frozenset(
+            tuple(typecheck(h, pair_of(int)))
+            for h in holidays if not isinstance(h, date))
+        # Dated holidays are finite, so business days keep recurring
+        # unless every weekday is a weekend day or every day of the
+        # year is an annual holiday.
+        if self.weekend >= frozenset(range(7)):
+            raise ValueError("weekend covers every day of the week")
+        if len(self.annual_holidays & ALL_MONTH_DAYS) == len(ALL_MONTH_DAYS):
+            raise ValueError("holidays cover every day of the year")
+        self.__year_dates = {}
+
+    def is_business_day(self, day):
+        return not (day.weekday() in self.weekend or
+                    day in self.holiday_dates or
+                    (day.month, day.day) in self.annual_holidays)
+
+    def __step(self, day, step):
+        while not self.is_business_day(day):
+            day += step
+        return day
+
+    def roll(self, day):
+        """Return DAY adjusted according to the roll convention."""
+        convention = self.roll_convention
+        if convention is None or self.is_business_day(day):
+            return day
+        step = timedelta(days=1)
+        if convention.endswith("preceding"):
+            step = -step
+        rolled = self.__step(day, step)
+        if convention.startswith("modified_") and rolled.month != day.month:
+            rolled = self.__step(day, -step)
+        return rolled
+
+    def year_dates(self, year, month_days):
+        """Expand recurring dates for one year.
+
+        MONTH_DAYS is a sequence of (MONTH, DAY) pairs; pairs that do
+        not name a real date in YEAR (like (2, 30)) are skipped.
+        Return a tuple of (NOMINAL, ROLLED) date pairs sorted by
+        NOMINAL, where ROLLED is NOMINAL adjusted by the roll
+        convention."""
+        key = (year, tuple(tuple(md) for md in month_days))
+        expanded = self.__year_dates.get(key)
+        if expanded is None:
+            nominal = []
+            for month, day in key[1]:
+                try:
+                    nominal.append(date(year, month, day))
+                except ValueError:
+                    pass
+            expanded = tuple((d, self.roll(d)) for d in sorted(nominal))
+            self.__year_dates[key] = expanded
+        return expanded
+
+    def scheduled_between(self, start, end, month_days):
+        """Return a list of (NOMINAL, ROLLED) pairs for [START, END).
+
+        The dates are the recurring MONTH_DAYS pairs, expanded as for
+        year_dates, for every year touching the range.  A pair is
+        included if its rolled date falls in the range.  The list is
+        sorted by rolled date."""
+        scheduled = []
+        for year in range(start.year - 1, end.year + 2):
+            scheduled.extend(
+                (nominal, rolled)
+                for nominal, rolled in self.year_dates(year, month_days)
+                if start <= rolled < end)
+        scheduled.sort(key=lambda pair: pair[1])
+        return scheduled
+
+    def dates_between(self, start, end, month_days):
+        """Return a sorted list of rolled dates in [START, END).
+
+        Dates are chosen as for scheduled_between."""
+        return [rolled for _, rolled
+                in self.scheduled_between(start, end, month_days)]
+
+DEFAULT_CALENDAR = PayCalendar()
+
+def iterdates(start, end):
+    return (start + timedelta(n) for n in range(0, (end - start).days))
 
 def gen_raw_pay(offer,
                 start_date,
                 end_date,
                 paydays,
-                vests):
+                vests,
+                calendar = DEFAULT_CALENDAR):
     """Generate pre-tax income events.
 
-    Inputs are as for the pay_info function.
+    OFFER is an Offer object; START_DATE and END_DATE bound the
+    half-open range of days to consider.  PAYDAYS is a tuple of
+    day-numbers-of-month on which normal cash pay is received; VESTS
+    is a sequence of vesting events as generated by
+    make_earnings_table.  CALENDAR is a PayCalendar that decides on
+    which business days scheduled pay actually arrives.
 
     Each income event is a tuple of (DAY, CASH, and EQUITY).  DAY is a
     datetime.date object giving the day of income dispersal; CASH and
     EQUITY (either or both of which can be zero) is the amount of
-    money earned on that day."""
-    for day in iterdates(start_date, end_date):
-        cash, equity = pay_info(offer, day, start_date, paydays, vests)
-        yield (day, cash, equity)
+    money earned on that day.  Events are sorted by day, and only days
+    with income appear."""
+    payday_dates = tuple((month, day)
+                         for month in range(1, 13)
+                         for day in paydays)
+    pay = offer.base / (12*len(paydays))
+
+    nbonus = len(offer.bonus_dates)
+    if nbonus:
+        bonus_period = 365 / nbonus
+        bonus_amount = (offer.bonus_target * offer.base) / nbonus
+
+    def signing():
+        if start_date < end_date:
+            yield (start_date, offer.bonus, 0)
+
+    def salary():
+        for nominal, day in calendar.scheduled_between(start_date, end_date,
+                                                       payday_dates):
+            if nominal > start_date:
+                yield (day, pay, 0)
+
+    def bonuses():
+        for day in calendar.dates_between(start_date, end_date,
+                                          offer.bonus_dates):
+            yield (day,
+                   bonus_amount * min(1.0,
+                                      (day - start_date).days / bonus_period),
+                   0)
+
+    def equity():
+        for voffer, vdate, vamount in sorted(vests, key=lambda v: v[1]):
+            if voffer is offer and start_date <= vdate < end_date:
+                yield (vdate, 0, vamount)
+
+    events = heapq.merge(signing(), salary(), bonuses(), equity(),
+                         key=lambda event: event[0])
+    for day, day_events in groupby(events, key=lambda event: event[0]):
+        cash = 0
+        equity_amount = 0
+        for _, event_cash, event_equity in day_events:
+            cash += event_cash
+            equity_amount += event_equity
+        yield (day, cash, equity_amount)
 
 def make_vests(
         total,
         annual_ratios,
         start_date,
-        vesting_dates):
+        vesting_dates,
+        calendar = DEFAULT_CALENDAR):
     """Generate a vesting schedule for a grant.
 
     TOTAL is the total value, in dollars, of the grant.  ANNUAL_RATIOS
@@ -429,6 +883,7 @@ def make_vests(
     datetime.date object indicating when the grant clock starts
     ticking.  VESTING_DATES is a sequence of (MONTH, DAY) tuples that
     indicate the months and days when grants vest each year.
+    CALENDAR is a PayCalendar used to move vests to business days.
 
     Return a sequence of (VDATE, VAMOUNT) tuples; each VDATE is a date
     on which a vest happens; and VAMOUNT is the amount, in dollars,
@@ -437,22 +892,57 @@ def make_vests(
     """
     vests = []
     cliff_vest_day = start_date.replace(year = start_date.year + 1)
-    vests.append((cliff_vest_day, annual_ratios[0] * total))
+    vests.append((calendar.roll(cliff_vest_day), annual_ratios[0] * total))
     annual_ratios = annual_ratios[1:]
+    if annual_ratios and not vesting_dates:
+        raise ValueError("post-cliff vesting requires vesting dates")
+    year = cliff_vest_day.year
     nrv = 0
-    d = cliff_vest_day + timedelta(days=1)
     while annual_ratios:
-        if (d.month, d.day) in vesting_dates:
-            dist_from_cliff = d - cliff_vest_day
+        for nominal, rolled in calendar.year_dates(year, vesting_dates):
+            if nominal <= cliff_vest_day or not annual_ratios:
+                continue
             frac = annual_ratios[0] / len(vesting_dates)
-            vests.append((d, frac * total))
+            vests.append((rolled, frac * total))
             nrv += 1
-        if nrv == len(vesting_dates):
-            nrv = 0
-            annual_ratios = annual_ratios[1:]
-        d += timedelta(days=1)
+            if nrv == len(vesting_dates):
+                nrv = 0
+                annual_ratios = annual_ratios[1:]
+        year += 1
     return vests
 
+def make_valued_vests(
+        offer,
+        total,
+        grant_price,
+        annual_ratios,
+        start_date,
+        vesting_dates,
+        calendar = DEFAULT_CALENDAR):
+    """Generate a vesting schedule for a grant made under OFFER.
+
+    If OFFER has no price series, this function is just make_vests.
+    Otherwise, convert TOTAL dollars to shares at GRANT_PRICE (or, if
+    GRANT_PRICE is None, at the price on START_DATE) and value each
+    vest at the price on its vest date.  Other arguments and the
+    return value are as for make_vests.
+
+    """
+    if offer.prices is None:
+        return make_vests(total, annual_ratios, start_date, vesting_dates,
+                          calendar)
+    if grant_price is None:
+        grant_price = offer.prices.price_on(start_date)
+    vests = make_vests(
+        total / grant_price,
+        annual_ratios,
+        start_date,
+        vesting_dates,
+        calendar)
+    vest_prices = offer.prices.prices_on(vdate for vdate, _ in vests)
+    return [(vdate, nr_shares * price)
+            for (vdate, nr_shares), price in zip(vests, vest_prices)]
+
 def gnuplot_quote(s):
     s = shlex.quote(s)
     if not s or s[0] not in ('"', "'"):
@@ -471,7 +961,8 @@ def make_earnings_table(
         taxes,
         already_earned_first_year,
         already_earned_state,
-        paydays):
+        paydays,
+        calendar = DEFAULT_CALENDAR):
     end_date = start_date.replace(
         year = start_date.year + nr_years,
     )
@@ -483,14 +974,17 @@ def make_earnings_table(
         if offer.refresher_amount:
             if not offer_grants:
                 raise ValueError("refresher specified with no initial grant")
-            for day in iterdates(start_date, end_date):
-                if (day.month, day.day) in offer.refresher_dates:
-                    offer_vests.extend(
-                        make_vests(
-                            offer.refresher_amount,
-                            offer_grants[0].vesting,
-                            day,
-                            offer_grants[0].vesting_dates))
+            for day in calendar.dates_between(start_date, end_date,
+                                              offer.refresher_dates):
+                offer_vests.extend(
+                    make_valued_vests(
+                        offer,
+                        offer.refresher_amount,
+                        None,
+                        offer_grants[0].vesting,
+                        day,
+                        offer_grants[0].vesting_dates,
+                        calendar))
         for grant in offer_grants:
             grant_start = grant.start
             if grant_start is None:
@@ -503,11 +997,14 @@ def make_earnings_table(
                 raise ValueError("grant starts before job start",
                                  offer, grant_start, start_date)
             offer_vests.extend(
-                make_vests(
+                make_valued_vests(
+                    offer,
                     grant.total,
+                    grant.grant_price,
                     grant.vesting,
                     grant_start,
-                    grant.vesting_dates))
+                    grant.vesting_dates,
+                    calendar))
         vests.extend(tuple([offer] + list(x) for x in offer_vests))
 
     if taxes:
@@ -524,24 +1021,26 @@ def make_earnings_table(
                      start_date,
                      tax_end_date,
                      paydays,
-                     vests)])
+                     vests,
+                     calendar)])
             for offer in offers)
 
+    offer_pay = tuple(
+        {day: (cash, equity)
+         for day, cash, equity
+         in gen_raw_pay(offer, start_date, end_date, paydays, vests, calendar)}
+        for offer in offers)
+
     data = []
     for day in iterdates(start_date, end_date):
         fields = [day]
         for i, offer in enumerate(offers):
-            cash, equity = pay_info(
-                offer,
-                day,
-                start_date,
-                paydays,
-                vests)
+            cash, equity = offer_pay[i].get(day, (0, 0))
             tax = 0
             if taxes and (cash > 0 or equity > 0):
-                taxes = offer_taxes[i]
-                taxed_cash = taxes.calculate_take_home_pay(day, cash)
-                taxed_equity = taxes.calculate_take_home_pay(day, equity)
+                offer_tax = offer_taxes[i]
+                taxed_cash = offer_tax.calculate_take_home_pay(day, cash)
+                taxed_equity = offer_tax.calculate_take_home_pay(day, equity)
                 tax = (cash - taxed_cash) + (equity - taxed_equity)
                 cash = taxed_cash
                 equity = taxed_equity
@@ -550,6 +1049,400 @@ def make_earnings_table(
 
     return tuple(accumulate(data, add_rows_pairwise))
 
+OfferSummary = namedtuple("OfferSummary", ("cash", "equity", "total", "tax"))
+ScenarioResult = namedtuple("ScenarioResult",
+                            ("index", "scenario", "summary", "error"))
+
+class Scenario(object):
+    """Describes one run of make_earnings_table"""
+    def __init__(self, *,
+                 offers,
+                 start_date,
+                 name = None,
+                 nr_years = DEFAULT_NR_YEARS,
+                 taxes = Taxes2016,
+                 paydays = DEFAULT_PAYDAYS,
+                 calendar = DEFAULT_CALENDAR,
+                 already_earned_first_year = 0,
+                 already_earned_state = None):
+        """Object representing a scenario to evaluate.
+
+        NAME is an optional string identifying the scenario.  The
+        other arguments are as for make_offer_comparison.
+
+        """
+        self.name = typecheck(name, (str, type(None)))
+        self.offers = typecheck(offers, seq_of(Offer))
+        self.start_date = typecheck(start_date, date)
+        self.nr_years = typecheck(nr_years, int)
+        if taxes is not None and not issubclass(taxes, Taxes):
+            raise TypeError(taxes)
+        self.taxes = taxes
+        self.paydays = typecheck(paydays, seq_of(int))
+        self.calendar = typecheck(calendar, PayCalendar)
+        self.already_earned_first_year = typecheck(
+            already_earned_first_year, numbers.Real)
+        self.already_earned_state = typecheck(
+            already_earned_state, (str, type(None)))
+
+def summarize_scenario(scenario):
+    """Compute the earnings table for SCENARIO and summarize it.
+
+    Return a tuple of OfferSummary objects, one for each offer in the
+    scenario, giving cumulative cash, equity, total, and tax at the
+    end of the scenario's time range."""
+    data = make_earnings_table(
+        scenario.offers,
+        scenario.start_date,
+        scenario.nr_years,
+        scenario.taxes,
+        scenario.already_earned_first_year,
+        scenario.already_earned_state,
+        scenario.paydays,
+        scenario.calendar)
+    last_row = data[-1]
+    return tuple(OfferSummary(*last_row[1 + 4*i:5 + 4*i])
+                 for i in range(len(scenario.offers)))
+
+def _submit_scenarios(executor, scenarios, pending, max_pending):
+    """Submit scenarios until MAX_PENDING futures are in flight.
+
+    SCENARIOS is an iterator of (INDEX, SCENARIO) pairs; PENDING maps
+    each in-flight future to its pair."""
+    for index, scenario in scenarios:
+        future = executor.submit(summarize_scenario, scenario)
+        pending[future] = (index, scenario)
+        if len(pending) >= max_pending:
+            break
+
+def _scenario_result(index, scenario, future):
+    if future.cancelled():
+        return ScenarioResult(index, scenario, None, CancelledError())
+    error = future.exception()
+    if error is not None:
+        log.debug("scenario:%r failed: %r", scenario.name or index, error)
+        return ScenarioResult(index, scenario, None, error)
+    return ScenarioResult(index, scenario, future.result(), None)
+
+def _check_scenario_args(jobs, max_pending):
+    """Validate JOBS and MAX_PENDING; return the effective MAX_PENDING."""
+    typecheck(jobs, int)
+    if jobs < 1:
+        raise ValueError("jobs must be positive", jobs)
+    if max_pending is None:
+        max_pending = 2 * jobs
+    typecheck(max_pending, int)
+    if max_pending < 1:
+        raise ValueError("max_pending must be positive", max_pending)
+    return max_pending
+
+def iter_scenario_results(scenarios,
+                          *,
+                          jobs = 1,
+                          max_pending = None,
+                          executor = None):
+    """Evaluate scenarios concurrently, yielding results as they finish.
+
+    SCENARIOS is an iterable of Scenario objects; it is consumed
+    lazily, so it may be a generator of any length.  At most
+    MAX_PENDING scenarios (by default, twice JOBS) are submitted but
+    not yet yielded at any time.
+
+    EXECUTOR is a concurrent.futures executor on which to run
+    summarize_scenario.  If None, use a process pool of JOBS workers,
+    shut down when iteration ends; scripts that rely on this must be
+    importable without side effects, as for any process pool.
+
+    Yield ScenarioResult tuples in completion order.  INDEX is the
+    scenario's position in SCENARIOS.  If evaluating a scenario
+    raised, ERROR is the exception and SUMMARY is None; otherwise,
+    SUMMARY is as returned by summarize_scenario and ERROR is None.
+    Closing the iterator cancels scenarios not yet started.
+
+    """
+    max_pending = _check_scenario_args(jobs, max_pending)
+    return _iter_scenario_results(
+        enumerate(scenarios), jobs, max_pending, executor)
+
+def _iter_scenario_results(scenarios, jobs, max_pending, executor):
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    pending = {}
+    try:
+        _submit_scenarios(executor, scenarios, pending, max_pending)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, scenario = pending.pop(future)
+                yield _scenario_result(index, scenario, future)
+            _submit_scenarios(executor, scenarios, pending, max_pending)
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def aiter_scenario_results(scenarios,
+                           *,
+                           jobs = 1,
+                           max_pending = None,
+                           executor = None):
+    """Asynchronous version of iter_scenario_results.
+
+    Arguments and results are as for iter_scenario_results.  Waiting
+    for results does not block the event loop.  Cancelling the
+    consuming task, or closing the iterator, cancels scenarios not
+    yet started."""
+    max_pending = _check_scenario_args(jobs, max_pending)
+    return _aiter_scenario_results(
+        enumerate(scenarios), jobs, max_pending, executor)
+
+async def _aiter_scenario_results(scenarios, jobs, max_pending, executor):
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    pending = {}
+    waiters = {}
+    try:
+        _submit_scenarios(executor, scenarios, pending, max_pending)
+        while pending:
+            for future in pending:
+                if future not in waiters:
+                    waiters[future] = asyncio.wrap_future(future)
+            await asyncio.wait(waiters.values(),
+                               return_when=asyncio.FIRST_COMPLETED)
+            for future, waiter in tuple(waiters.items()):
+                if waiter.done():
+                    del waiters[future]
+                    index, scenario = pending.pop(future)
+                    yield _scenario_result(index, scenario, waiter)
+            _submit_scenarios(executor, scenarios, pending, max_pending)
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def write_earnings_data(data, output):
+    """Write the rows of an earnings table to the stream OUTPUT.
+
+    DATA is a sequence of rows as returned by make_earnings_table.
+    Rows are written one per line, with fields separated by spaces,
+    in the format gnuplot expects for both inline and file data."""
+    for data_entry in data:
+        print(*data_entry, file=output)
+
+def write_gnuplot_plot(
+        output,
+        *,
+        data_ref,
+        offers,
+        offer_colors,
+        taxes,
+        start_date,
+        nr_years,
+        terminal,
+        plot_output,
+        series,
+        series_styles,
+        title,
+        show_dollars):
+    """Write gnuplot formatting and plot commands to the stream OUTPUT.
+
+    DATA_REF is the gnuplot expression naming the earnings data: either
+    an inline datablock like "$data" or a quoted file name.
+    OFFER_COLORS parallels OFFERS.  TERMINAL and PLOT_OUTPUT are the
+    gnuplot terminal string and output file (or None).  The remaining
+    arguments are as for make_offer_comparison."""
+    formatting = [
+        'set terminal ' + terminal,
+    ]
+
+    if plot_output is not None:
+        formatting.append('set output ' + gnuplot_quote(plot_output))
+
+    manual_top_tics = []
+    epoch = datetime.utcfromtimestamp(0)
+    for yearno in range(0, nr_years+3):
+        anniversary = start_date.replace(year = start_date.year + yearno)
+        anniversary_dt = datetime.combine(anniversary, datetime.min.time())
+        anniversary_unix_time = (anniversary_dt - epoch).total_seconds()
+        label = "Year %u" % (yearno+1)
+        manual_top_tics.append(
+            "%s %r" % (gnuplot_quote(label), anniversary_unix_time) )
+
+    formatting.extend([
+        'set decimal locale',
+        'set link x',
+        'set xdata time',
+        'set xtics rotate by -90',
+        'set x2tics (%s)' % ",".join(manual_top_tics),
+        'set timefmt "%Y-%m-%d"',
+        'set format x "%Y/%m"',
+        'set format y "$%\'.0f"',
+        'set key left',
+        'set linestyle 10 lc rgb "#dddddd" lw 1',
+        'set grid ytics mytics x2tics linestyle 10',
+        'set mytics',
+        'set y2tics',
+        'set format y2 "$%\'.0f"',
+    ])
+
+    if title:
+        formatting.append('set title %s' % gnuplot_quote(title))
+
+    if not show_dollars:
+        formatting.append('set format y ""')
+        formatting.append('set format y2 ""')
+
+    print("\n".join(formatting), file=output)
+    print("plot \\", file=output)
+    for i, offer in enumerate(offers):
+        offer_column = 1 + 4*i
+        for column_index, column_title in (
+                (offer_column + 0, "cash"),
+                (offer_column + 1, "equity"),
+                (offer_column + 2, "total"),
+                (offer_column + 3, "tax"),
+        ):
+            if column_title not in series:
+                continue
+            words = [data_ref, "using", "1:%s" % (1 + column_index)]
+            title_tags = [column_title]
+            if column_title == "tax":
+                if not taxes:
+                    continue
+            else:
+                if taxes is None:
+                    title_tags.append("pre-tax")
+                else:
+                    title_tags.append("post-tax")
+            human_title = "%s %s (%s)" % (
+                offer.name, offer.state, ", ".join(title_tags))
+            words.extend(("title", gnuplot_quote(human_title), "noenhanced"))
+            words.extend(("with", "lines"))
+            words.extend(("linecolor", gnuplot_quote(offer_colors[i])))
+            words.extend(series_styles.get(column_title, ()))
+            print(" ".join(words) + ", \\", file=output)
+    print("", file=output)
+
+def offer_year_incomes(data, offers, year):
+    """Return each offer's pre-tax income during calendar YEAR.
+
+    DATA is a table as returned by make_earnings_table for OFFERS.
+    Return a tuple parallel to OFFERS, or None if DATA does not cover
+    all of YEAR."""
+    before = None
+    last = None
+    for row in data:
+        if row[0].year < year:
+            before = row
+        elif row[0].year == year:
+            last = row
+    if last is None or last[0] != date(year, 12, 31):
+        return None
+    def pretax(row, i):
+        if row is None:
+            return 0
+        return row[3 + 4*i] + row[4 + 4*i]
+    return tuple(pretax(last, i) - pretax(before, i)
+                 for i in range(len(offers)))
+
+def write_tax_sensitivity_plot(
+        output,
+        surface,
+        *,
+        terminal,
+        plot_output,
+        title = None,
+        markers = ()):
+    """Write a gnuplot script graphing a TaxSurface to the stream OUTPUT.
+
+    Each state split gets a solid effective-rate line and a dashed
+    marginal-rate line; points mark incomes at which the AMT binds.
+    TERMINAL and PLOT_OUTPUT are as for write_gnuplot_plot, and TITLE
+    is the graph title.  MARKERS is a sequence of (LABEL, INCOME,
+    COLOR) tuples drawn as labeled vertical lines, usually one for
+    each offer being compared."""
+    print("$rates <<EOD", file=output)
+    for i, split in enumerate(surface.splits):
+        if i:
+            print("\n", file=output)
+        for income, effective, marginal, amt_binding in zip(
+                surface.incomes,
+                surface.effective[i],
+                surface.marginal[i],
+                surface.amt_binding[i]):
+            print(income, 100.0 * effective, 100.0 * marginal,
+                  int(amt_binding), file=output)
+    print("EOD", file=output)
+
+    formatting = [
+        'set terminal ' + terminal,
+    ]
+    if plot_output is not None:
+        formatting.append('set output ' + gnuplot_quote(plot_output))
+    formatting.extend([
+        'set decimal locale',
+        'set format x "$%\'.0f"',
+        'set xtics rotate by -90',
+        'set format y "%g%%"',
+        'set key left',
+        'set linestyle 10 lc rgb "#dddddd" lw 1',
+        'set grid xtics ytics linestyle 10',
+    ])
+    if title:
+        formatting.append('set title %s' % gnuplot_quote(title))
+    for n, (label, income, color) in enumerate(markers):
+        formatting.append(
+            'set arrow %d from %r, graph 0 to %r, graph 1 nohead lc rgb %s'
+            % (n + 1, income, income, gnuplot_quote(color)))
+        formatting.append(
+            'set label %d %s at %r, graph 0.95 rotate by 90 right '
+            'offset -1,0 noenhanced'
+            % (n + 1, gnuplot_quote(label), income))
+    print("\n".join(formatting), file=output)
+
+    colors = list(reversed(AUTO_COLORS))
+    print("plot \\", file=output)
+    for i, split in enumerate(surface.splits):
+        color = gnuplot_quote(colors.pop() if colors else "black")
+        label = describe_split(split)
+        for column, kind, styles in (
+                (2, "effective", ()),
+                (3, "marginal", DEFAULT_SERIES_STYLES["cash"]),
+        ):
+            words = ["$rates", "index", str(i), "using", "1:%d" % column,
+                     "title", gnuplot_quote("%s (%s)" % (label, kind)),
+                     "noenhanced", "with", "lines", "linecolor", color]
+            words.extend(styles)
+            print(" ".join(words) + ", \\", file=output)
+        words = ["$rates", "index", str(i), "using", "1:($4 ? $3 : 1/0)",
+                 "title", gnuplot_quote("%s (AMT binds)" % label),
+                 "noenhanced", "with", "points", "pointtype", "7",
+                 "linecolor", color]
+        print(" ".join(words) + ", \\", file=output)
+    print("", file=output)
+
+def run_gnuplot_scripts(scripts, *, jobs = 1, gnuplot = DEFAULT_GNUPLOT):
+    """Run gnuplot on each file in SCRIPTS.
+
+    At most JOBS gnuplot processes run at once.  GNUPLOT is the name
+    of the gnuplot executable.  Every script is run even if some fail;
+    afterward, raise subprocess.CalledProcessError for the first
+    failure, if any."""
+    typecheck(jobs, int)
+    if jobs < 1:
+        raise ValueError("jobs must be positive", jobs)
+    def render(script):
+        log.debug("rendering script:%r", script)
+        subprocess.run([gnuplot, script], check=True)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(render, script) for script in scripts]
+    for future in futures:
+        future.result()
+
 def make_offer_comparison(
         *,
         argv,
@@ -559,12 +1452,18 @@ def make_offer_comparison(
         output = sys.stdout,
         taxes = Taxes2016,
         paydays = DEFAULT_PAYDAYS,
+        calendar = DEFAULT_CALENDAR,
         already_earned_first_year = 0,
         already_earned_state = None,
         series = DEFAULT_SERIES,
         series_styles = DEFAULT_SERIES_STYLES,
         title = None,
-        show_dollars = True):
+        show_dollars = True,
+        targets = None,
+        data_path = None,
+        sensitivity = None,
+        jobs = 0,
+        gnuplot = DEFAULT_GNUPLOT):
     """Entry point for valleyjudge.
 
     ARGV is the program's argument array; you want to use sys.argv.
@@ -581,7 +1480,9 @@ def make_offer_comparison(
     not compute tax information; pre-tax figures will be graphed.
 
     PAYDAYS is a list of day-numbers indicating the days of the month
-    one receives paychecks.
+    one receives paychecks.  CALENDAR is a PayCalendar that moves
+    paydays, bonuses, and vests falling on weekends and holidays to
+    business days.
 
     ALREADY_EARNED_FIRST_YEAR and ALREADY_EARNED_STATE are an amount
     of dollars earned in the year on which you accept the offer and
@@ -603,6 +1504,20 @@ def make_offer_comparison(
     want to generate a graph showing the relative values of various
     offers without revealing exactly how much you're making.
 
+    TARGETS, if not None, is a sequence of RenderTarget objects.  In
+    this mode, the earnings table is computed once and written to the
+    file DATA_PATH, and a separate gnuplot script that reads
+    DATA_PATH is written for each target; OUTPUT is not used.  If JOBS
+    is positive, also run GNUPLOT on these scripts, at most JOBS at a
+    time.  Return a tuple of the script file names.
+
+    SENSITIVITY, if not None, is a RenderTarget for a graph of
+    effective and marginal tax rates (see tax_sensitivity) for the
+    states of OFFERS, marked with each offer's pre-tax income in the
+    first full calendar year after START_DATE.  Its script is written
+    and rendered along with TARGETS.  Its SERIES and SHOW_DOLLARS
+    are ignored.
+
     """
 
     typecheck(start_date, date)
@@ -610,9 +1525,15 @@ def make_offer_comparison(
     if taxes is not None and not issubclass(taxes, Taxes):
         raise TypeError(taxes)
     typecheck(paydays, seq_of(int))
+    typecheck(calendar, PayCalendar)
     typecheck(already_earned_first_year, numbers.Real)
     typecheck(already_earned_state, (str, type(None)))
     typecheck(offers, seq_of(Offer))
+    typecheck(targets, (seq_of(RenderTarget), type(None)))
+    typecheck(data_path, (str, type(None)))
+    typecheck(sensitivity, (RenderTarget, type(None)))
+    if sensitivity is not None and targets is None:
+        raise ValueError("SENSITIVITY requires TARGETS")
 
     ap = ArgumentParser(description="Compare job offers")
     ap.add_argument("--debug", help="Turn on debug logging",
@@ -623,6 +1544,8 @@ def make_offer_comparison(
                     default=None)
     ap.add_argument("--notaxes", help="Disable tax calculation",
                     action="store_true")
+    ap.add_argument("--jobs", help="Number of concurrent gnuplot renders",
+                    type=int, default=jobs)
     args = ap.parse_args(argv[1:])
 
     logging_level = logging.DEBUG if args.debug else logging.WARNING
@@ -641,81 +1564,90 @@ def make_offer_comparison(
         taxes,
         already_earned_first_year,
         already_earned_state,
-        paydays)
-
-    print("$data <<EOD", file=output)
-    for data_entry in data:
-        print(*data_entry)
-    print("EOD", file=output)
+        paydays,
+        calendar)
+
+    if targets is None:
+        print("$data <<EOD", file=output)
+        write_earnings_data(data, output)
+        print("EOD", file=output)
+        del data
+        write_gnuplot_plot(
+            output,
+            data_ref = "$data",
+            offers = offers,
+            offer_colors = offer_colors,
+            taxes = taxes,
+            start_date = start_date,
+            nr_years = nr_years,
+            terminal = args.terminal,
+            plot_output = args.output,
+            series = series,
+            series_styles = series_styles,
+            title = title,
+            show_dollars = show_dollars)
+        return None
+
+    if data_path is None:
+        raise ValueError("render targets require a DATA_PATH")
+    with open(data_path, "w") as data_file:
+        write_earnings_data(data, data_file)
+    if sensitivity is not None:
+        year_incomes = offer_year_incomes(
+            data, offers, start_date.year + 1)
     del data
-    formatting = [
-        'set terminal ' + args.terminal,
-    ]
-
-    if args.output is not None:
-        formatting.append('set output ' + gnuplot_quote(args.output))
-
-    manual_top_tics = []
-    epoch = datetime.utcfromtimestamp(0)
-    for yearno in range(0, nr_years+3):
-        anniversary = start_date.replace(year = start_date.year + yearno)
-        anniversary_dt = datetime.combine(anniversary, datetime.min.time())
-        anniversary_unix_time = (anniversary_dt - epoch).total_seconds()
-        label = "Year %u" % (yearno+1)
-        manual_top_tics.append(
-            "%s %r" % (gnuplot_quote(label), anniversary_unix_time) )
 
-    formatting.extend([
-        'set decimal locale',
-        'set link x',
-        'set xdata time',
-        'set xtics rotate by -90',
-        'set x2tics (%s)' % ",".join(manual_top_tics),
-        'set timefmt "%Y-%m-%d"',
-        'set format x "%Y/%m"',
-        'set format y "$%\'.0f"',
-        'set key left',
-        'set linestyle 10 lc rgb "#dddddd" lw 1',
-        'set grid ytics mytics x2tics linestyle 10',
-        'set mytics',
-        'set y2tics',
-        'set format y2 "$%\'.0f"',
-    ])
-
-    if title:
-        formatting.append('set title %s' % gnuplot_quote(title))
-
-    if not show_dollars:
-        formatting.append('set format y ""')
-        formatting.append('set format y2 ""')
-
-    print("\n".join(formatting), file=output)
-    print("plot \\", file=output)
-    for i, offer in enumerate(offers):
-        offer_column = 1 + 4*i
-        for column_index, column_title in (
-                (offer_column + 0, "cash"),
-                (offer_column + 1, "equity"),
-                (offer_column + 2, "total"),
-                (offer_column + 3, "tax"),
-        ):
-            if column_title not in series:
-                continue
-            words = ["$data", "using", "1:%s" % (1 + column_index)]
-            title_tags = [column_title]
-            if column_title == "tax":
-                if not taxes:
-                    continue
-            else:
-                if taxes is None:
-                    title_tags.append("pre-tax")
-                else:
-                    title_tags.append("post-tax")
-            human_title = "%s %s (%s)" % (
-                offer.name, offer.state, ", ".join(title_tags))
-            words.extend(("title", gnuplot_quote(human_title), "noenhanced"))
-            words.extend(("with", "lines"))
-            words.extend(("linecolor", gnuplot_quote(offer_colors[i])))
-            words.extend(series_styles.get(column_title, ()))
-            print(" ".join(words) + ", \\", file=output)
-    print("", file=output)
+    scripts = []
+    for target in targets:
+        script = target.script or target.output + ".gp"
+        with open(script, "w") as script_file:
+            write_gnuplot_plot(
+                script_file,
+                data_ref = gnuplot_quote(data_path),
+                offers = offers,
+                offer_colors = offer_colors,
+                taxes = taxes,
+                start_date = start_date,
+                nr_years = nr_years,
+                terminal = (args.terminal if target.terminal is None
+                            else target.terminal),
+                plot_output = target.output,
+                series = series if target.series is None else target.series,
+                series_styles = series_styles,
+                title = title if target.title is None else target.title,
+                show_dollars = (show_dollars if target.show_dollars is None
+                                else target.show_dollars))
+        log.debug("wrote script:%r for output:%r", script, target.output)
+        scripts.append(script)
+
+    if sensitivity is not None:
+        states = sorted(set(offer.state for offer in offers))
+        markers = ()
+        if year_incomes is None:
+            log.warning("nr_years:%d does not cover calendar year %d; "
+                        "omitting offer markers from tax sensitivity graph",
+                        nr_years, start_date.year + 1)
+        else:
+            markers = tuple(
+                ("%s %s" % (offer.name, offer.state), income,
+                 offer_colors[i])
+                for i, (offer, income)
+                in enumerate(zip(offers, year_incomes)))
+        script = sensitivity.script or sensitivity.output + ".gp"
+        with open(script, "w") as script_file:
+            write_tax_sensitivity_plot(
+                script_file,
+                tax_sensitivity(
+                    splits = tuple({state: 1.0} for state in states),
+                    taxes = taxes or Taxes2016),
+                terminal = (args.terminal if sensitivity.terminal is None
+                            else sensitivity.terminal),
+                plot_output = sensitivity.output,
+                title = ("Tax rates" if sensitivity.title is None
+                         else sensitivity.title),
+                markers = markers)
+        scripts.append(script)
+
+    if args.jobs:
+        run_gnuplot_scripts(scripts, jobs=args.jobs, gnuplot=gnuplot)
+    return tuple(scripts)